@@ -56,21 +56,38 @@ def piecewise_linear(t, schedule):
     if schedule[0][0] != 0:
         schedule = [(0, 0.)] + schedule
 
-    x = K.constant(schedule[0][1], dtype=K.floatx())
-    t = K.cast(t, K.floatx())
-    for i in range(len(schedule)):
-        t_begin = schedule[i][0]
-        x_begin = x
-        if i != len(schedule) - 1:
-            dx = schedule[i + 1][1] - schedule[i][1]
-            dt = schedule[i + 1][0] - schedule[i][0]
-            slope = 1. * dx / dt
-            x = schedule[i][1] + slope * (t - t_begin)
-        else:
-            x = K.constant(schedule[i][1], dtype=K.floatx())
-        x = K.switch(t >= t_begin, x, x_begin)
-
-    return x
+    if len(schedule) == 1:
+        return K.constant(schedule[0][1], dtype=K.floatx())
+
+    # 用searchsorted定位t所在的区间，然后做一次线性插值，
+    # 这样图的大小与schedule的长度无关
+    ts = K.constant([i[0] for i in schedule], dtype=K.floatx())
+    xs = K.constant([i[1] for i in schedule], dtype=K.floatx())
+    t = K.clip(K.cast(t, K.floatx()), schedule[0][0], schedule[-1][0])
+    i = tf.searchsorted(ts, K.reshape(t, [1]), side='right')[0]
+    i = K.clip(i, 1, len(schedule) - 1)
+    t_begin, t_end = K.gather(ts, i - 1), K.gather(ts, i)
+    x_begin, x_end = K.gather(xs, i - 1), K.gather(xs, i)
+    return x_begin + (x_end - x_begin) * (t - t_begin) / (t_end - t_begin)
+
+
+def xla_function(f):
+    """将f包装为用XLA编译的tf.function（兼容不同版本的tf）
+    tf 2.5+用jit_compile，tf 2.1～2.4用experimental_compile，
+    更早的版本不支持XLA编译，则直接返回f本身。
+    """
+    if not hasattr(tf, 'function'):
+        return f
+    for kwargs in [
+        {'jit_compile': True, 'reduce_retracing': True},
+        {'jit_compile': True},
+        {'experimental_compile': True},
+    ]:
+        try:
+            return tf.function(f, **kwargs)
+        except TypeError:
+            pass
+    return f
 
 
 def search_layer(inputs, name, exclude=None):
@@ -3,15 +3,102 @@
 
 import tensorflow as tf
 from bert4keras.backend import keras, K, is_tf_keras
-from bert4keras.snippets import is_string, string_matching
-from bert4keras.snippets import is_one_of
-from bert4keras.backend import piecewise_linear
+from bert4keras.snippets import is_string
+from bert4keras.backend import piecewise_linear, xla_function
 import re
 
 
+def _adam_delta(m_t, v_t, lr, epsilon, beta_1_power=None,
+                beta_2_power=None):
+    """由更新后的m、v计算参数的变化量
+    传入beta_1_power、beta_2_power时，进行偏差修正。
+    """
+    if beta_1_power is not None:
+        m_t = m_t / (1. - beta_1_power)
+        v_t = v_t / (1. - beta_2_power)
+    return lr * m_t / (K.sqrt(v_t) + epsilon)
+
+
+def _adam_math(var,
+               m,
+               v,
+               grad,
+               lr,
+               beta_1,
+               beta_2,
+               epsilon,
+               beta_1_power=None,
+               beta_2_power=None):
+    """Adam的（稠密）更新公式，返回(m_t, v_t, var_t)
+    按lr的精度计算，结果分别转回m、v、var的精度；
+    只负责计算，赋值操作留给调用者。
+    """
+    dtype, compute_dtype = var.dtype.base_dtype, lr.dtype.base_dtype
+    m_dtype, v_dtype = m.dtype.base_dtype, v.dtype.base_dtype
+    m = K.cast(m, compute_dtype)
+    v = K.cast(v, compute_dtype)
+    grad = K.cast(grad, compute_dtype)
+    m_t = beta_1 * m + (1 - beta_1) * grad
+    v_t = beta_2 * v + (1 - beta_2) * grad**2
+    var_delta = _adam_delta(m_t, v_t, lr, epsilon, beta_1_power,
+                            beta_2_power)
+    var_t = K.cast(var, compute_dtype) - var_delta
+    m_t, v_t = K.cast(m_t, m_dtype), K.cast(v_t, v_dtype)
+    return m_t, v_t, K.cast(var_t, dtype)
+
+
+def _adam_sparse_increments(grad, one_minus_beta_1, one_minus_beta_2,
+                            dtype):
+    """稀疏更新时要累加到m、v对应行上的量，
+    即((1 - beta_1) * grad, (1 - beta_2) * grad**2)，结果转为dtype。
+    """
+    m_inc = one_minus_beta_1 * grad
+    v_inc = one_minus_beta_2 * K.square(grad)
+    return K.cast(m_inc, dtype), K.cast(v_inc, dtype)
+
+
+def _var_key(var):
+    """参数的唯一标识，与optimizer_v2内部管理slots的方式一致
+    （分布式下各副本的分量映射回同一个key）
+    """
+    if hasattr(var, '_distributed_container'):
+        var = var._distributed_container()
+    if getattr(var, '_in_graph_mode', False):
+        return var._shared_name
+    return var._unique_id
+
+
+def _colocate_with(var):
+    """新建的变量与var放在同一设备上（分布式下逐副本创建）
+    """
+    if hasattr(tf, 'distribute') and hasattr(tf.distribute, 'get_strategy'):
+        return tf.distribute.get_strategy().extended.colocate_vars_with(var)
+    return tf.compat.v1.colocate_with(var)
+
+
+def _trust_ratio(x, dx, lr):
+    """层自适应学习率的校正比例，即 ||x|| / ||dx / lr||
+    只算两个平方和，然后用一次rsqrt合并；任一模长过小时返回1。
+    """
+    x_sq = K.sum(K.square(x))
+    g_sq = K.sum(K.square(dx)) / K.square(lr)
+    ratio = K.sqrt(x_sq) * tf.math.rsqrt(g_sq)
+    cond = tf.logical_and(x_sq > 0., g_sq > K.epsilon()**2)
+    return tf.where(cond, ratio, K.ones_like(ratio))
+
+
+# XLA编译版本，将整个计算链融合为一个kernel
+# （Adam的稠密更新只需读一遍var、m、v、grad，写出三个结果）
+_adam_math_xla = xla_function(_adam_math)
+_adam_sparse_increments_xla = xla_function(_adam_sparse_increments)
+_trust_ratio_xla = xla_function(_trust_ratio)
+
+
 class Adam(keras.optimizers.Optimizer):
     """重新定义Adam优化器，便于派生出新的优化器
     （tensorflow的optimizer_v2类）
+    use_xla: 稠密参数的更新公式是否用XLA编译（float64参数除外）。
+    半精度参数的m、v用float32保存，避免(1 - beta_2) * grad**2下溢。
     """
     def __init__(self,
                  learning_rate=0.001,
@@ -20,6 +107,7 @@ class Adam(keras.optimizers.Optimizer):
                  epsilon=1e-6,
                  bias_correction=True,
                  name='Adam',
+                 use_xla=False,
                  **kwargs):
         kwargs['name'] = name
         super(Adam, self).__init__(**kwargs)
@@ -28,50 +116,183 @@ class Adam(keras.optimizers.Optimizer):
         self._set_hyper('beta_2', beta_2)
         self.epsilon = epsilon or K.epislon()
         self.bias_correction = bias_correction
+        self.use_xla = use_xla
+        self._compute_slots = {}
 
     def _create_slots(self, var_list):
         for var in var_list:
-            self.add_slot(var, 'm')
-            self.add_slot(var, 'v')
+            compute_dtype = self._compute_dtype(var.dtype.base_dtype)
+            if compute_dtype == var.dtype.base_dtype:
+                self.add_slot(var, 'm')
+                self.add_slot(var, 'v')
+            else:
+                for slot_name in ['m', 'v']:
+                    self._add_compute_slot(var, slot_name, compute_dtype)
 
-    def _resource_apply_op(self, grad, var, indices=None):
+    def _add_compute_slot(self, var, slot_name, dtype):
+        """新建精度为dtype的slot（add_slot只能与var同精度）
+        """
+        key = (_var_key(var), slot_name)
+        if key not in self._compute_slots:
+            name = '%s/%s' % (var.name.split(':')[0], slot_name)
+            with _colocate_with(var):
+                self._compute_slots[key] = self.add_weight(
+                    name,
+                    shape=var.shape,
+                    dtype=dtype,
+                    initializer='zeros',
+                    trainable=False
+                )
+        return self._compute_slots[key]
+
+    def get_slot(self, var, slot_name):
+        key = (_var_key(var), slot_name)
+        if key in self._compute_slots:
+            return self._compute_slots[key]
+        return super(Adam, self).get_slot(var, slot_name)
+
+    def _prepare_local(self, var_device, var_dtype, apply_state):
+        """每步只计算一次的系数，缓存到apply_state中
+        （tf 2.1+的optimizer_v2会按(device, dtype)自动调用）
+        """
+        if hasattr(super(Adam, self), '_prepare_local'):
+            super(Adam, self)._prepare_local(var_device, var_dtype,
+                                             apply_state)
+        coefficients = apply_state[(var_device, var_dtype)]
+        # Adam自身的系数都按计算精度算好；lr_t另外保留一份原精度的，
+        # 供权重衰减、层自适应等后处理使用
+        compute_dtype = self._compute_dtype(var_dtype)
+        if compute_dtype != var_dtype:
+            compute_lr_t = self._decayed_lr(compute_dtype)
+            coefficients['lr_t'] = K.cast(compute_lr_t, var_dtype)
+        else:
+            if 'lr_t' not in coefficients:
+                coefficients['lr_t'] = self._decayed_lr(var_dtype)
+            compute_lr_t = coefficients['lr_t']
+        coefficients['compute_lr_t'] = compute_lr_t
+        beta_1_t = self._get_hyper('beta_1', compute_dtype)
+        beta_2_t = self._get_hyper('beta_2', compute_dtype)
+        coefficients['beta_1_t'] = beta_1_t
+        coefficients['beta_2_t'] = beta_2_t
+        coefficients['one_minus_beta_1_t'] = 1 - beta_1_t
+        coefficients['one_minus_beta_2_t'] = 1 - beta_2_t
+        coefficients['epsilon_t'] = K.cast(self.epsilon, compute_dtype)
+        if self.bias_correction:
+            local_step = K.cast(self.iterations + 1, compute_dtype)
+            coefficients['beta_1_power'] = K.pow(beta_1_t, local_step)
+            coefficients['beta_2_power'] = K.pow(beta_2_t, local_step)
+        else:
+            coefficients['beta_1_power'] = None
+            coefficients['beta_2_power'] = None
+
+    def _compute_dtype(self, var_dtype):
+        """更新公式的计算精度：半精度参数统一用float32计算
+        """
+        if var_dtype in [tf.float16, tf.bfloat16]:
+            return tf.float32
+        return var_dtype
+
+    def _get_coefficients(self, var, apply_state=None):
+        """取出var对应的缓存系数
+        低版本tf不会传入apply_state，此时就地计算。
+        """
+        key = (var.device, var.dtype.base_dtype)
+        if apply_state is None or key not in apply_state:
+            apply_state = {key: {}}
+            self._prepare_local(key[0], key[1], apply_state)
+        return apply_state[key]
+
+    def _resource_apply_op(self, grad, var, indices=None, apply_state=None):
         # 准备变量
         var_dtype = var.dtype.base_dtype
-        lr_t = self._decayed_lr(var_dtype)
+        coefficients = self._get_coefficients(var, apply_state)
         m = self.get_slot(var, 'm')
         v = self.get_slot(var, 'v')
-        beta_1_t = self._get_hyper('beta_1', var_dtype)
-        beta_2_t = self._get_hyper('beta_2', var_dtype)
-        epsilon_t = K.cast(self.epsilon, var_dtype)
-        local_step = K.cast(self.iterations + 1, var_dtype)
-        beta_1_t_power = K.pow(beta_1_t, local_step)
-        beta_2_t_power = K.pow(beta_2_t, local_step)
+        # 半精度参数的更新公式统一用float32计算，结果再转回原精度
+        compute_dtype = self._compute_dtype(var_dtype)
+
+        def cast(x):
+            return K.cast(x, compute_dtype)
+
+        lr_t = coefficients['compute_lr_t']
+        beta_1_t = coefficients['beta_1_t']
+        beta_2_t = coefficients['beta_2_t']
+        one_minus_beta_1_t = coefficients['one_minus_beta_1_t']
+        one_minus_beta_2_t = coefficients['one_minus_beta_2_t']
+        epsilon_t = coefficients['epsilon_t']
+        beta_1_power = coefficients['beta_1_power']
+        beta_2_power = coefficients['beta_2_power']
+        grad = cast(grad)
 
         # 更新公式
         if indices is None:
-            m_t = K.update(m, beta_1_t * m + (1 - beta_1_t) * grad)
-            v_t = K.update(v, beta_2_t * v + (1 - beta_2_t) * grad**2)
+            if self.use_xla and var_dtype != tf.float64:
+                adam_math = _adam_math_xla
+            else:
+                adam_math = _adam_math
+            m_t, v_t, var_t = adam_math(var, m, v, grad, lr_t, beta_1_t,
+                                        beta_2_t, epsilon_t, beta_1_power,
+                                        beta_2_power)
+            mv_ops = [K.update(m, m_t), K.update(v, v_t)]
         else:
-            mv_ops = [K.update(m, beta_1_t * m), K.update(v, beta_2_t * v)]
+            m_dtype, v_dtype = m.dtype.base_dtype, v.dtype.base_dtype
+            mv_ops = [
+                K.update(m, K.cast(beta_1_t * cast(m), m_dtype)),
+                K.update(v, K.cast(beta_2_t * cast(v), v_dtype))
+            ]
+            # 稀疏梯度的形状一般随batch变化，只在形状固定（如TPU）时
+            # 才用XLA，否则每个新形状都要重新编译
+            if (self.use_xla and var_dtype != tf.float64 and
+                    grad.shape.is_fully_defined()):
+                sparse_increments = _adam_sparse_increments_xla
+            else:
+                sparse_increments = _adam_sparse_increments
+            m_inc, v_inc = sparse_increments(grad, one_minus_beta_1_t,
+                                             one_minus_beta_2_t, m_dtype)
             with tf.control_dependencies(mv_ops):
-                m_t = self._resource_scatter_add(m, indices,
-                                                 (1 - beta_1_t) * grad)
-                v_t = self._resource_scatter_add(v, indices,
-                                                 (1 - beta_2_t) * grad**2)
+                m_t = self._resource_scatter_add(m, indices, m_inc)
+                v_t = self._resource_scatter_add(v, indices, v_inc)
+            mv_ops = [m_t, v_t]
+            with tf.control_dependencies(mv_ops):
+                var_delta = _adam_delta(cast(m_t), cast(v_t), lr_t,
+                                        epsilon_t, beta_1_power, beta_2_power)
+                var_t = K.cast(cast(var) - var_delta, var_dtype)
 
         # 返回算子
-        with tf.control_dependencies([m_t, v_t]):
-            if self.bias_correction:
-                m_t = m_t / (1. - beta_1_t_power)
-                v_t = v_t / (1. - beta_2_t_power)
-            var_t = var - lr_t * m_t / (K.sqrt(v_t) + self.epsilon)
-            return K.update(var, var_t)
+        with tf.control_dependencies(mv_ops):
+            var_t = self._transform_update(var, var_t, grad, indices,
+                                           apply_state)
+            return self._assign_update(var, var_t, grad, indices,
+                                       apply_state)
+
+    def _transform_update(self,
+                          var,
+                          var_t,
+                          grad,
+                          indices=None,
+                          apply_state=None):
+        """对参数的新值var_t做后处理，供派生的优化器重载
+        默认不做任何处理。只在构建图时调用；分布式下var是各副本的
+        分量，需要按参数名而非id判断是否处理。
+        """
+        return var_t
+
+    def _assign_update(self,
+                       var,
+                       var_t,
+                       grad,
+                       indices=None,
+                       apply_state=None):
+        """将新值var_t写入参数，供派生的优化器重载
+        默认整体赋值。
+        """
+        return K.update(var, var_t)
 
-    def _resource_apply_dense(self, grad, var):
-        return self._resource_apply_op(grad, var)
+    def _resource_apply_dense(self, grad, var, apply_state=None):
+        return self._resource_apply_op(grad, var, apply_state=apply_state)
 
-    def _resource_apply_sparse(self, grad, var, indices):
-        return self._resource_apply_op(grad, var, indices)
+    def _resource_apply_sparse(self, grad, var, indices, apply_state=None):
+        return self._resource_apply_op(grad, var, indices, apply_state)
 
     def get_config(self):
         config = {
@@ -79,9 +300,33 @@ class Adam(keras.optimizers.Optimizer):
             'beta_1': self._serialize_hyperparameter('beta_1'),
             'beta_2': self._serialize_hyperparameter('beta_2'),
             'epsilon': self.epsilon,
+            'use_xla': self.use_xla,
         }
         base_config = super(Adam, self).get_config()
-        return dict(list(base_config.items()) + list(config.items()))
+        return dict(base_config, **config)
+
+
+class _KerasUpdateTransform(object):
+    """原生keras的优化器在get_updates中直接调用K.update，
+    因此只能在get_updates期间临时替换K.update，使参数的新值
+    先经过cls._transform_update(optimizer, x, new_x)处理。
+    按cls分派，多个wrapper嵌套时各自只执行自己那一层的处理。
+    """
+    def __init__(self, optimizer, cls):
+        self.optimizer = optimizer
+        self.cls = cls
+
+    def __enter__(self):
+        self.old_update = K.update
+        K.update = self.update
+        return self
+
+    def __exit__(self, *args):
+        K.update = self.old_update
+
+    def update(self, x, new_x):
+        new_x = self.cls._transform_update(self.optimizer, x, new_x)
+        return self.old_update(x, new_x)
 
 
 def extend_with_weight_decay(base_optimizer, name=None):
@@ -98,27 +343,28 @@ def extend_with_weight_decay(base_optimizer, name=None):
             super(new_optimizer, self).__init__(*args, **kwargs)
             self.weight_decay_rate = weight_decay_rate
             self.exclude_from_weight_decay = exclude_from_weight_decay or []
+            self._weight_decay_patterns = [
+                re.compile(n) for n in self.exclude_from_weight_decay
+            ]
             if not hasattr(self, 'learning_rate'):
                 self.learning_rate = self.lr
 
         @K.symbolic
         def get_updates(self, loss, params):
-            old_update = K.update
+            # 预先算好需要权重衰减的参数，避免每次更新都做正则匹配
+            self._decay_ids = set(
+                id(p) for p in params if self._do_weight_decay(p))
+            with _KerasUpdateTransform(self, new_optimizer):
+                return super(new_optimizer, self).get_updates(loss, params)
 
-            def new_update(x, new_x):
-                if is_one_of(x, params) and self._do_weight_decay(x):
-                    new_x = new_x - self.learning_rate * self.weight_decay_rate * x
-                return old_update(x, new_x)
-
-            K.update = new_update
-            updates = super(new_optimizer, self).get_updates(loss, params)
-            K.update = old_update
-
-            return updates
+        def _transform_update(self, x, new_x):
+            if id(x) in self._decay_ids:
+                new_x = new_x - self.learning_rate * self.weight_decay_rate * x
+            return new_x
 
         def _do_weight_decay(self, w):
-            return (not string_matching(w.name,
-                                        self.exclude_from_weight_decay))
+            return not any(
+                p.search(w.name) for p in self._weight_decay_patterns)
 
         def get_config(self):
             config = {
@@ -126,7 +372,7 @@ def extend_with_weight_decay(base_optimizer, name=None):
                 'exclude_from_weight_decay': self.exclude_from_weight_decay
             }
             base_config = super(new_optimizer, self).get_config()
-            return dict(list(base_config.items()) + list(config.items()))
+            return dict(base_config, **config)
 
     if is_string(name):
         new_optimizer.__name__ = name
@@ -149,26 +395,27 @@ def extend_with_weight_decay_v2(base_optimizer, name=None):
             super(new_optimizer, self).__init__(*args, **kwargs)
             self.weight_decay_rate = weight_decay_rate
             self.exclude_from_weight_decay = exclude_from_weight_decay or []
+            self._weight_decay_patterns = [
+                re.compile(n) for n in self.exclude_from_weight_decay
+            ]
 
-        def _resource_apply_op(self, grad, var, indices=None):
-            old_update = K.update
-
-            def new_update(x, new_x):
-                if x is var and self._do_weight_decay(x):
-                    lr_t = self._decayed_lr(x.dtype.base_dtype)
-                    new_x = new_x - lr_t * self.weight_decay_rate * x
-                return old_update(x, new_x)
-
-            K.update = new_update
-            op = super(new_optimizer,
-                       self)._resource_apply_op(grad, var, indices)
-            K.update = old_update
-
-            return op
+        def _transform_update(self,
+                              var,
+                              var_t,
+                              grad,
+                              indices=None,
+                              apply_state=None):
+            var_t = super(new_optimizer,
+                          self)._transform_update(var, var_t, grad, indices,
+                                                  apply_state)
+            if self._do_weight_decay(var):
+                lr_t = self._get_coefficients(var, apply_state)['lr_t']
+                var_t = var_t - lr_t * self.weight_decay_rate * var
+            return var_t
 
         def _do_weight_decay(self, w):
-            return (not string_matching(w.name,
-                                        self.exclude_from_weight_decay))
+            return not any(
+                p.search(w.name) for p in self._weight_decay_patterns)
 
         def get_config(self):
             config = {
@@ -176,7 +423,7 @@ def extend_with_weight_decay_v2(base_optimizer, name=None):
                 'exclude_from_weight_decay': self.exclude_from_weight_decay
             }
             base_config = super(new_optimizer, self).get_config()
-            return dict(list(base_config.items()) + list(config.items()))
+            return dict(base_config, **config)
 
     if is_string(name):
         new_optimizer.__name__ = name
@@ -197,35 +444,30 @@ def extend_with_layer_adaptation(base_optimizer, name=None):
                      **kwargs):
             super(new_optimizer, self).__init__(*args, **kwargs)
             self.exclude_from_layer_adaptation = exclude_from_layer_adaptation or []
+            self._layer_adaptation_patterns = [
+                re.compile(n) for n in self.exclude_from_layer_adaptation
+            ]
             if not hasattr(self, 'learning_rate'):
                 self.learning_rate = self.lr
 
         @K.symbolic
         def get_updates(self, loss, params):
-            old_update = K.update
-
-            def new_update(x, new_x):
-                if is_one_of(x, params) and self._do_layer_adaptation(x):
-                    dx = new_x - x
-                    lr_t = K.clip(self.learning_rate, K.epsilon(), 1e10)
-                    x_norm = tf.norm(x)
-                    g_norm = tf.norm(dx / lr_t)
-                    ratio = K.switch(
-                        x_norm > 0.,
-                        K.switch(g_norm > K.epsilon(), x_norm / g_norm, 1.),
-                        1.)
-                    new_x = x + dx * ratio
-                return old_update(x, new_x)
-
-            K.update = new_update
-            updates = super(new_optimizer, self).get_updates(loss, params)
-            K.update = old_update
-
-            return updates
+            # 预先算好需要层自适应的参数，避免每次更新都做正则匹配
+            self._adaptation_ids = set(
+                id(p) for p in params if self._do_layer_adaptation(p))
+            with _KerasUpdateTransform(self, new_optimizer):
+                return super(new_optimizer, self).get_updates(loss, params)
+
+        def _transform_update(self, x, new_x):
+            if id(x) in self._adaptation_ids:
+                dx = new_x - x
+                lr_t = K.clip(self.learning_rate, K.epsilon(), 1e10)
+                new_x = x + dx * _trust_ratio(x, dx, lr_t)
+            return new_x
 
         def _do_layer_adaptation(self, w):
-            return (not string_matching(w.name,
-                                        self.exclude_from_layer_adaptation))
+            return not any(
+                p.search(w.name) for p in self._layer_adaptation_patterns)
 
         def get_config(self):
             config = {
@@ -233,7 +475,7 @@ def extend_with_layer_adaptation(base_optimizer, name=None):
                 self.exclude_from_layer_adaptation
             }
             base_config = super(new_optimizer, self).get_config()
-            return dict(list(base_config.items()) + list(config.items()))
+            return dict(base_config, **config)
 
     if is_string(name):
         new_optimizer.__name__ = name
@@ -254,34 +496,33 @@ def extend_with_layer_adaptation_v2(base_optimizer, name=None):
                      **kwargs):
             super(new_optimizer, self).__init__(*args, **kwargs)
             self.exclude_from_layer_adaptation = exclude_from_layer_adaptation or []
+            self._layer_adaptation_patterns = [
+                re.compile(n) for n in self.exclude_from_layer_adaptation
+            ]
 
-        def _resource_apply_op(self, grad, var, indices=None):
-            old_update = K.update
-
-            def new_update(x, new_x):
-                if x is var and self._do_layer_adaptation(x):
-                    dx = new_x - x
-                    lr_t = self._decayed_lr(x.dtype.base_dtype)
-                    lr_t = K.clip(lr_t, K.epsilon(), 1e10)
-                    x_norm = tf.norm(x)
-                    g_norm = tf.norm(dx / lr_t)
-                    ratio = K.switch(
-                        x_norm > 0.,
-                        K.switch(g_norm > K.epsilon(), x_norm / g_norm, 1.),
-                        1.)
-                    new_x = x + dx * ratio
-                return old_update(x, new_x)
-
-            K.update = new_update
-            op = super(new_optimizer,
-                       self)._resource_apply_op(grad, var, indices)
-            K.update = old_update
-
-            return op
+        def _transform_update(self,
+                              var,
+                              var_t,
+                              grad,
+                              indices=None,
+                              apply_state=None):
+            var_t = super(new_optimizer,
+                          self)._transform_update(var, var_t, grad, indices,
+                                                  apply_state)
+            if self._do_layer_adaptation(var):
+                dx = var_t - var
+                lr_t = self._get_coefficients(var, apply_state)['lr_t']
+                lr_t = K.clip(lr_t, K.epsilon(), 1e10)
+                if self.use_xla and var.dtype.base_dtype != tf.float64:
+                    trust_ratio = _trust_ratio_xla
+                else:
+                    trust_ratio = _trust_ratio
+                var_t = var + dx * trust_ratio(var, dx, lr_t)
+            return var_t
 
         def _do_layer_adaptation(self, w):
-            return (not string_matching(w.name,
-                                        self.exclude_from_layer_adaptation))
+            return not any(
+                p.search(w.name) for p in self._layer_adaptation_patterns)
 
         def get_config(self):
             config = {
@@ -289,7 +530,7 @@ def extend_with_layer_adaptation_v2(base_optimizer, name=None):
                 self.exclude_from_layer_adaptation
             }
             base_config = super(new_optimizer, self).get_config()
-            return dict(list(base_config.items()) + list(config.items()))
+            return dict(base_config, **config)
 
     if is_string(name):
         new_optimizer.__name__ = name
@@ -313,25 +554,21 @@ def extend_with_piecewise_linear_lr(base_optimizer, name=None):
 
         @K.symbolic
         def get_updates(self, loss, params):
-            lr_multiplier = piecewise_linear(self.iterations, self.lr_schedule)
+            self._lr_multiplier = piecewise_linear(self.iterations,
+                                                   self.lr_schedule)
+            self._lr_schedule_ids = set(id(p) for p in params)
+            with _KerasUpdateTransform(self, new_optimizer):
+                return super(new_optimizer, self).get_updates(loss, params)
 
-            old_update = K.update
-
-            def new_update(x, new_x):
-                if is_one_of(x, params):
-                    new_x = x + (new_x - x) * lr_multiplier
-                return old_update(x, new_x)
-
-            K.update = new_update
-            updates = super(new_optimizer, self).get_updates(loss, params)
-            K.update = old_update
-
-            return updates
+        def _transform_update(self, x, new_x):
+            if id(x) in self._lr_schedule_ids:
+                new_x = x + (new_x - x) * self._lr_multiplier
+            return new_x
 
         def get_config(self):
             config = {'lr_schedule': self.lr_schedule}
             base_config = super(new_optimizer, self).get_config()
-            return dict(list(base_config.items()) + list(config.items()))
+            return dict(base_config, **config)
 
     if is_string(name):
         new_optimizer.__name__ = name
@@ -361,7 +598,7 @@ def extend_with_piecewise_linear_lr_v2(base_optimizer, name=None):
         def get_config(self):
             config = {'lr_schedule': self.lr_schedule}
             base_config = super(new_optimizer, self).get_config()
-            return dict(list(base_config.items()) + list(config.items()))
+            return dict(base_config, **config)
 
     if is_string(name):
         new_optimizer.__name__ = name
@@ -393,6 +630,7 @@ def extend_with_gradient_accumulation(base_optimizer, name=None):
             # 更新判据
             cond = K.equal(self.iterations % self.grad_accum_steps, 0)
             cond = K.cast(cond, K.floatx())
+            self._accum_cond = cond
             # 获取梯度
             grads = self.get_gradients(loss, params)
             self.accum_grads = [
@@ -401,15 +639,8 @@ def extend_with_gradient_accumulation(base_optimizer, name=None):
                         name='accum_grad_%s' % i) for i, p in enumerate(params)
             ]
 
-            old_update = K.update
-
-            def new_update(x, new_x):
-                new_x = cond * new_x + (1 - cond) * x
-                return old_update(x, new_x)
-
-            K.update = new_update
-            updates = super(new_optimizer, self).get_updates(loss, params)
-            K.update = old_update
+            with _KerasUpdateTransform(self, new_optimizer):
+                updates = super(new_optimizer, self).get_updates(loss, params)
 
             # 累积梯度
             with tf.control_dependencies(updates):
@@ -420,10 +651,13 @@ def extend_with_gradient_accumulation(base_optimizer, name=None):
 
             return accum_updates
 
+        def _transform_update(self, x, new_x):
+            return self._accum_cond * new_x + (1 - self._accum_cond) * x
+
         def get_config(self):
             config = {'grad_accum_steps': self.grad_accum_steps}
             base_config = super(new_optimizer, self).get_config()
-            return dict(list(base_config.items()) + list(config.items()))
+            return dict(base_config, **config)
 
     if is_string(name):
         new_optimizer.__name__ = name
@@ -447,38 +681,55 @@ def extend_with_gradient_accumulation_v2(base_optimizer, name=None):
             for var in var_list:
                 self.add_slot(var, 'ag')
 
-        def _resource_apply_op(self, grad, var, indices=None):
-            # 更新判据
+        def _prepare_local(self, var_device, var_dtype, apply_state):
+            super(new_optimizer, self)._prepare_local(var_device, var_dtype,
+                                                      apply_state)
+            # 更新判据（每步只算一次）
             cond = K.equal(self.iterations % self.grad_accum_steps, 0)
+            apply_state[(var_device, var_dtype)]['accum_cond'] = cond
+
+        def _resource_apply_op(self,
+                               grad,
+                               var,
+                               indices=None,
+                               apply_state=None):
+            # 更新判据
+            cond = self._get_coefficients(var, apply_state)['accum_cond']
             # 获取梯度
             ag = self.get_slot(var, 'ag')
 
-            old_update = K.update
-
-            def new_update(x, new_x):
-                new_x = K.switch(cond, new_x, x)
-                return old_update(x, new_x)
-
-            K.update = new_update
-            ag_t = ag / self.grad_accum_steps
-            op = super(new_optimizer, self)._resource_apply_op(ag_t, var)
-            K.update = old_update
-
-            # 累积梯度
-            with tf.control_dependencies([op]):
-                ag_t = K.switch(cond, K.zeros_like(ag), ag)
-                with tf.control_dependencies([K.update(ag, ag_t)]):
+            def apply_accum_grad():
+                ag_t = ag / self.grad_accum_steps
+                op = super(new_optimizer,
+                           self)._resource_apply_op(ag_t,
+                                                    var,
+                                                    apply_state=apply_state)
+                # 用完后直接以当前梯度作为新的累积梯度
+                # （稀疏梯度只在这里稠密化，每grad_accum_steps步一次）
+                with tf.control_dependencies([op]):
                     if indices is None:
-                        ag_t = K.update(ag, ag + grad)
+                        grad_t = grad
                     else:
-                        ag_t = self._resource_scatter_add(ag, indices, grad)
-
-            return ag_t
+                        grad_t = tf.scatter_nd(
+                            K.expand_dims(indices, 1), grad,
+                            tf.shape(ag, out_type=indices.dtype))
+                    return tf.group(K.update(ag, grad_t))
+
+            def accum_grad():
+                # 累积梯度（稀疏梯度只累加到对应的行）
+                if indices is None:
+                    return tf.group(K.update_add(ag, grad))
+                else:
+                    return tf.group(
+                        self._resource_scatter_add(ag, indices, grad))
+
+            # 只在更新步才执行原优化器的更新公式
+            return tf.cond(cond, apply_accum_grad, accum_grad)
 
         def get_config(self):
             config = {'grad_accum_steps': self.grad_accum_steps}
             base_config = super(new_optimizer, self).get_config()
-            return dict(list(base_config.items()) + list(config.items()))
+            return dict(base_config, **config)
 
     if is_string(name):
         new_optimizer.__name__ = name
@@ -517,18 +768,18 @@ def extend_with_lookahead(base_optimizer, name=None):
                         name='slow_var_%s' % i) for i, p in enumerate(params)
             ]
 
+            def sync_slow_vars():
+                # 快慢权重同步：新的慢权重同时赋值给两者
+                sync_updates = []
+                for p, q in zip(params, slow_vars):
+                    q_t = q + alpha * (p - q)
+                    sync_updates.extend([K.update(q, q_t), K.update(p, q_t)])
+                return tf.group(*sync_updates)
+
             with tf.control_dependencies(updates):
-                slow_updates = [
-                    K.update(q, K.switch(cond, q + alpha * (p - q), q))
-                    for p, q in zip(params, slow_vars)
-                ]
-                with tf.control_dependencies(slow_updates):
-                    copy_updates = [
-                        K.update(p, K.switch(cond, q, p))
-                        for p, q in zip(params, slow_vars)
-                    ]
+                slow_update = tf.cond(cond, sync_slow_vars, tf.no_op)
 
-            return copy_updates
+            return [slow_update]
 
         def get_config(self):
             config = {
@@ -536,7 +787,7 @@ def extend_with_lookahead(base_optimizer, name=None):
                 'slow_step_size': self.slow_step_size
             }
             base_config = super(new_optimizer, self).get_config()
-            return dict(list(base_config.items()) + list(config.items()))
+            return dict(base_config, **config)
 
     if is_string(name):
         new_optimizer.__name__ = name
@@ -568,22 +819,34 @@ def extend_with_lookahead_v2(base_optimizer, name=None):
             for var in var_list:
                 self.add_slot(var, 'slow_var')
 
-        def _resource_apply_op(self, grad, var, indices=None):
+        def _prepare_local(self, var_device, var_dtype, apply_state):
+            super(new_optimizer, self)._prepare_local(var_device, var_dtype,
+                                                      apply_state)
+            # 同步判据（每步只算一次）
+            cond = K.equal(self.iterations % self.steps_per_slow_update, 0)
+            apply_state[(var_device, var_dtype)]['lookahead_cond'] = cond
+
+        def _resource_apply_op(self,
+                               grad,
+                               var,
+                               indices=None,
+                               apply_state=None):
             op = super(new_optimizer,
-                       self)._resource_apply_op(grad, var, indices)
+                       self)._resource_apply_op(grad, var, indices,
+                                                apply_state)
 
-            k, alpha = self.steps_per_slow_update, self.slow_step_size
-            cond = K.equal(self.iterations % k, 0)
+            alpha = self.slow_step_size
+            cond = self._get_coefficients(var, apply_state)['lookahead_cond']
             slow_var = self.get_slot(var, 'slow_var')
-            slow_var_t = slow_var + alpha * (var - slow_var)
 
-            with tf.control_dependencies([op]):
-                slow_update = K.update(slow_var,
-                                       K.switch(cond, slow_var_t, slow_var))
-                with tf.control_dependencies([slow_update]):
-                    copy_update = K.update(var, K.switch(cond, slow_var, var))
+            def sync_slow_var():
+                # 快慢权重同步：新的慢权重同时赋值给两者
+                slow_var_t = slow_var + alpha * (var - slow_var)
+                return tf.group(K.update(slow_var, slow_var_t),
+                                K.update(var, slow_var_t))
 
-            return copy_update
+            with tf.control_dependencies([op]):
+                return tf.cond(cond, sync_slow_var, tf.no_op)
 
         def get_config(self):
             config = {
@@ -591,7 +854,7 @@ def extend_with_lookahead_v2(base_optimizer, name=None):
                 'slow_step_size': self.slow_step_size
             }
             base_config = super(new_optimizer, self).get_config()
-            return dict(list(base_config.items()) + list(config.items()))
+            return dict(base_config, **config)
 
     if is_string(name):
         new_optimizer.__name__ = name
@@ -611,6 +874,9 @@ def extend_with_lazy_optimization(base_optimizer, name=None):
         def __init__(self, include_in_lazy_optimization=None, *args, **kwargs):
             super(new_optimizer, self).__init__(*args, **kwargs)
             self.include_in_lazy_optimization = include_in_lazy_optimization or []
+            self._lazy_optimization_patterns = [
+                re.compile(n) for n in self.include_in_lazy_optimization
+            ]
             self._first_get_gradients = True
 
         def get_gradients(self, loss, params):
@@ -623,24 +889,21 @@ def extend_with_lazy_optimization(base_optimizer, name=None):
         @K.symbolic
         def get_updates(self, loss, params):
             self.grads = dict(zip(params, self.get_gradients(loss, params)))
-
-            old_update = K.update
-
-            def new_update(x, new_x):
-                if is_one_of(x, params) and self._do_lazy_optimization(x):
-                    g = self.grads[x]
-                    r = K.any(K.not_equal(g, 0.), axis=-1, keepdims=True)
-                    new_x = x + (new_x - x) * K.cast(r, K.floatx())
-                return old_update(x, new_x)
-
-            K.update = new_update
-            updates = super(new_optimizer, self).get_updates(loss, params)
-            K.update = old_update
-
-            return updates
+            self._lazy_ids = set(
+                id(p) for p in params if self._do_lazy_optimization(p))
+            with _KerasUpdateTransform(self, new_optimizer):
+                return super(new_optimizer, self).get_updates(loss, params)
+
+        def _transform_update(self, x, new_x):
+            if id(x) in self._lazy_ids:
+                g = self.grads[x]
+                r = K.any(K.not_equal(g, 0.), axis=-1, keepdims=True)
+                new_x = x + (new_x - x) * K.cast(r, K.floatx())
+            return new_x
 
         def _do_lazy_optimization(self, w):
-            return string_matching(w.name, self.include_in_lazy_optimization)
+            return any(
+                p.search(w.name) for p in self._lazy_optimization_patterns)
 
         def get_config(self):
             config = {
@@ -648,7 +911,7 @@ def extend_with_lazy_optimization(base_optimizer, name=None):
                 self.include_in_lazy_optimization
             }
             base_config = super(new_optimizer, self).get_config()
-            return dict(list(base_config.items()) + list(config.items()))
+            return dict(base_config, **config)
 
     if is_string(name):
         new_optimizer.__name__ = name
@@ -668,32 +931,41 @@ def extend_with_lazy_optimization_v2(base_optimizer, name=None):
         def __init__(self, include_in_lazy_optimization=None, *args, **kwargs):
             super(new_optimizer, self).__init__(*args, **kwargs)
             self.include_in_lazy_optimization = include_in_lazy_optimization or []
+            self._lazy_optimization_patterns = [
+                re.compile(n) for n in self.include_in_lazy_optimization
+            ]
 
-        def _resource_apply_op(self, grad, var, indices=None):
-            old_update = K.update
-
-            def new_update(x, new_x):
-                if x is var and self._do_lazy_optimization(x):
-                    if indices is None:
-                        r = K.any(K.not_equal(grad, 0.),
-                                  axis=-1,
-                                  keepdims=True)
-                        new_x = x + (new_x - x) * K.cast(r, K.floatx())
-                        return old_update(x, new_x)
-                    else:
-                        return self._resource_scatter_add(
-                            x, indices, K.gather(new_x - x, indices))
-                return old_update(x, new_x)
-
-            K.update = new_update
-            op = super(new_optimizer,
-                       self)._resource_apply_op(grad, var, indices)
-            K.update = old_update
-
-            return op
+        def _transform_update(self,
+                              var,
+                              var_t,
+                              grad,
+                              indices=None,
+                              apply_state=None):
+            var_t = super(new_optimizer,
+                          self)._transform_update(var, var_t, grad, indices,
+                                                  apply_state)
+            if indices is None and self._do_lazy_optimization(var):
+                r = K.any(K.not_equal(grad, 0.), axis=-1, keepdims=True)
+                var_t = var + (var_t - var) * K.cast(r, var_t.dtype)
+            return var_t
+
+        def _assign_update(self,
+                           var,
+                           var_t,
+                           grad,
+                           indices=None,
+                           apply_state=None):
+            if indices is not None and self._do_lazy_optimization(var):
+                # 稀疏梯度只写回indices对应的行
+                return self._resource_scatter_add(
+                    var, indices, K.gather(var_t - var, indices))
+            return super(new_optimizer,
+                         self)._assign_update(var, var_t, grad, indices,
+                                              apply_state)
 
         def _do_lazy_optimization(self, w):
-            return string_matching(w.name, self.include_in_lazy_optimization)
+            return any(
+                p.search(w.name) for p in self._lazy_optimization_patterns)
 
         def get_config(self):
             config = {
@@ -701,7 +973,7 @@ def extend_with_lazy_optimization_v2(base_optimizer, name=None):
                 self.include_in_lazy_optimization
             }
             base_config = super(new_optimizer, self).get_config()
-            return dict(list(base_config.items()) + list(config.items()))
+            return dict(base_config, **config)
 
     if is_string(name):
         new_optimizer.__name__ = name